@@ -1,15 +1,78 @@
 import argparse
-from internet_scholar import AthenaLogger, read_dict_from_s3_url, AthenaDatabase, compress
 from pathlib import Path
-import itertools
 import csv
 import gzip
-import boto3
-from datetime import datetime, timedelta
-import twint
+from datetime import datetime, timedelta, timezone
 import json
-import tweepy
 import sqlite3
+import hashlib
+import threading
+import queue
+import asyncio
+import time
+import cProfile
+import pstats
+import tracemalloc
+import resource
+import io
+import re
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# Every backend writes compact separators, keeps key order and leaves non-ASCII characters unescaped,
+# so exported lines parse to the same values whichever backend is installed. They are not always the same
+# bytes: orjson writes floats such as 1e16 and 1e-7 where the standard library writes 1e+16 and 1e-07.
+def _json_dumps_stdlib(obj):
+    json_line = json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+    # lone surrogates cannot be written as UTF-8: let json_dumps fall back to escaped ASCII
+    json_line.encode('utf-8')
+    return json_line
+
+
+JSON_BACKENDS = {'json': (_json_dumps_stdlib, json.loads)}
+if ujson is not None:
+    JSON_BACKENDS['ujson'] = (lambda obj: ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False),
+                              ujson.loads)
+if orjson is not None:
+    JSON_BACKENDS['orjson'] = (lambda obj: orjson.dumps(obj).decode('utf-8'), orjson.loads)
+
+JSON_BACKEND = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+
+
+def json_dumps(obj, backend=None):
+    try:
+        return JSON_BACKENDS[backend or JSON_BACKEND][0](obj)
+    except (TypeError, ValueError, OverflowError):
+        # lone surrogates and integers beyond 64 bits are rejected by the fast backends
+        return json.dumps(obj, separators=(',', ':'))
+
+
+def json_loads(json_line, backend=None):
+    try:
+        return JSON_BACKENDS[backend or JSON_BACKEND][1](json_line)
+    except ValueError:
+        return json.loads(json_line)
+
+
+# tweet ids are snowflakes: milliseconds since this epoch, shifted left by 22 bits
+TWITTER_EPOCH = 1288834974657
+
+
+def snowflake_from_datetime(moment):
+    return (int(moment.replace(tzinfo=timezone.utc).timestamp() * 1000) - TWITTER_EPOCH) << 22
+
 
 UNKNOWN_VIDEO_IDS = """
 select id.videoId as id
@@ -66,9 +129,6 @@ where
   creation_date = cast(current_date - interval '1' day as varchar)
 """
 
-YESTERDAY = """
-select cast(current_date - interval '1' day as varchar) as yesterday;
-"""
 
 # NEW_VIDEOS_TODAY = """
 # select id
@@ -85,7 +145,7 @@ from
   validated_url
 where
   url_extract_host(validated_url) = 'www.youtube.com'
-  and url_extract_parameter(validated_url, 'v') not in (select id from youtube_twitter_addition)
+  and creation_date >= '{since}'
 UNION DISTINCT
 select distinct
   id.videoId as id
@@ -93,7 +153,12 @@ from
   youtube_related_video
 where
   creation_date = cast(current_date as varchar)
-  and id.videoId not in (select id from youtube_twitter_addition)
+"""
+
+KNOWN_VIDEOS = """
+select id, creation_date
+from youtube_twitter_addition
+where creation_date >= '{since}'
 """
 
 CREATE_TABLE_TWEET_FROM_VIDEO_ID = """
@@ -118,6 +183,20 @@ CREATE TABLE IF NOT EXISTS tweet_from_screen_name
 )
 """
 
+CREATE_TABLE_HYBRID_TWEET = """
+CREATE TABLE IF NOT EXISTS hybrid_tweet
+(
+    id_str text,
+    collection text,
+    query text,
+    screen_name text,
+    backend text,
+    tweet json,
+    created_at timestamp default current_timestamp,
+    primary key (collection, id_str)
+)
+"""
+
 CREATE_TABLE_YOUTUBE_VIDEO_ID = """
 CREATE TABLE IF NOT EXISTS youtube_video_id
 (
@@ -127,6 +206,78 @@ CREATE TABLE IF NOT EXISTS youtube_video_id
 )
 """
 
+CREATE_TABLE_KNOWN_VIDEO = """
+CREATE TABLE IF NOT EXISTS known_video
+(
+    id text primary key,
+    creation_date text
+) WITHOUT ROWID
+"""
+
+CREATE_INDEX_KNOWN_VIDEO_CREATION_DATE = """
+CREATE INDEX IF NOT EXISTS known_video_creation_date on known_video (creation_date)
+"""
+
+CREATE_TABLE_SEARCH_WINDOW = """
+CREATE TABLE IF NOT EXISTS search_window
+(
+    method text,
+    collection text,
+    query text,
+    keys json,
+    since_at text,
+    until_at text,
+    since_id integer,
+    max_id integer,
+    processed integer default 0,
+    primary key (method, collection, query, since_at)
+)
+"""
+
+CREATE_TABLE_SEARCH_COVERAGE = """
+CREATE TABLE IF NOT EXISTS search_coverage
+(
+    method text,
+    collection text,
+    term text,
+    covered_since text,
+    covered_until text,
+    primary key (method, collection, term)
+)
+"""
+
+CREATE_TABLE_SEARCH_COVERAGE_TWEET = """
+CREATE TABLE IF NOT EXISTS search_coverage_tweet
+(
+    method text,
+    collection text,
+    term text,
+    id_str text,
+    screen_name text,
+    created_at text,
+    primary key (method, collection, term, id_str)
+) WITHOUT ROWID
+"""
+
+CREATE_TABLE_RUN_STATE = """
+CREATE TABLE IF NOT EXISTS run_state
+(
+    key text primary key,
+    value text
+)
+"""
+
+CREATE_TABLE_ATHENA_QUERY_CACHE = """
+CREATE TABLE IF NOT EXISTS athena_query_cache
+(
+    cache_key text primary key,
+    query_class text,
+    query text,
+    result json,
+    created_at timestamp default current_timestamp
+)
+"""
+
 CREATE_TABLE_USER = """
 create table if not exists twitter_user
 (
@@ -136,6 +287,26 @@ create table if not exists twitter_user
 )
 """
 
+CREATE_TABLE_USER_PROFILE = """
+create table if not exists twitter_user_profile
+(
+    screen_name text primary key collate nocase,
+    id_str text,
+    status text,
+    last_tweet_at timestamp,
+    profile json,
+    updated_at timestamp default current_timestamp
+)
+"""
+
+PENDING_USERS = """
+select twitter_user.screen_name
+from twitter_user
+left join twitter_user_profile on twitter_user_profile.screen_name = twitter_user.screen_name
+where twitter_user.processed = 0
+order by twitter_user_profile.last_tweet_at desc
+"""
+
 STRUCTURE_TWINT_ATHENA = """
 created_at timestamp,
 id bigint,
@@ -547,41 +718,469 @@ WITH SERDEPROPERTIES (
 TBLPROPERTIES ('has_encrypted_data'='false');
 """
 
+ATHENA_CREATE_TWEEPY_NORMALIZED = """
+CREATE EXTERNAL TABLE IF NOT EXISTS {table} (
+{structure}
+)
+PARTITIONED BY (reference_date String)
+ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
+WITH SERDEPROPERTIES (
+  'serialization.format' = '1',
+  'ignore.malformed.json' = 'true'
+) LOCATION 's3://{s3_bucket}/{table}/'
+TBLPROPERTIES ('has_encrypted_data'='false');
+"""
+
+
+def split_athena_structure(structure):
+    fields = list()
+    depth = 0
+    current = ''
+    for char in structure:
+        if char == '<':
+            depth += 1
+        elif char == '>':
+            depth -= 1
+        if char == ',' and depth == 0:
+            fields.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        fields.append(current.strip())
+    # top level fields read "name type" and struct members read "name: type"
+    return [tuple(re.split(r':?\s+', field, maxsplit=1)) for field in fields]
+
+
+def join_athena_structure(fields):
+    return ",\n".join(["{} {}".format(name, field_type) for name, field_type in fields])
+
+
+def struct_members(field_type):
+    return split_athena_structure(field_type[field_type.index('<') + 1:field_type.rindex('>')])
+
+
+def normalized_tweepy_structures():
+    fields = dict(split_athena_structure(STRUCTURE_TWEEPY_ATHENA))
+    tweet = [(name, field_type) for name, field_type in split_athena_structure(STRUCTURE_TWEEPY_ATHENA)
+             if name not in ('user', 'quoted_status', 'retweeted_status')]
+    tweet.extend([('user_id_str', 'string'), ('retweeted_status_id_str', 'string'), ('collection', 'string')])
+    embedded_status = [(name, field_type) for name, field_type in struct_members(fields['quoted_status'])
+                       if name != 'user']
+    embedded_status.append(('user_id_str', 'string'))
+    return {'tweepy_tweet': join_athena_structure(tweet),
+            'tweepy_user': join_athena_structure(struct_members(fields['user'])),
+            'tweepy_embedded_status': join_athena_structure(embedded_status)}
+
+
+STRUCTURE_HYBRID_ATHENA = """
+created_at timestamp,
+id bigint,
+id_str string,
+conversation_id string,
+text string,
+in_reply_to_status_id_str string,
+user_id bigint,
+user_id_str string,
+screen_name string,
+name string,
+replies_count bigint,
+likes_count bigint,
+retweets_count bigint,
+mentions array<string>,
+hashtags array<string>,
+urls array<string>,
+quote_url string,
+link string,
+source string,
+backend string
+"""
+
+ATHENA_CREATE_HYBRID_VIDEO_ID = """
+CREATE EXTERNAL TABLE IF NOT EXISTS hybrid_video_id (
+{structure}
+)
+PARTITIONED BY (reference_date String)
+ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
+WITH SERDEPROPERTIES (
+  'serialization.format' = '1',
+  'ignore.malformed.json' = 'true'
+) LOCATION 's3://{s3_bucket}/hybrid_video_id/'
+TBLPROPERTIES ('has_encrypted_data'='false');
+"""
+
+ATHENA_CREATE_HYBRID_SCREEN_NAME = """
+CREATE EXTERNAL TABLE IF NOT EXISTS hybrid_screen_name (
+{structure}
+)
+PARTITIONED BY (reference_date String)
+ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
+WITH SERDEPROPERTIES (
+  'serialization.format' = '1',
+  'ignore.malformed.json' = 'true'
+) LOCATION 's3://{s3_bucket}/hybrid_screen_name/'
+TBLPROPERTIES ('has_encrypted_data'='false');
+"""
 
 
 class TwitterSearch:
-    def __init__(self, credentials, athena_data, s3_admin, s3_data):
+    def __init__(self, credentials, athena_data, s3_admin, s3_data, profile_directory=None, normalized=False,
+                 s3_endpoint_url=None):
         self.credentials = credentials
         self.athena_data = athena_data
         self.s3_admin = s3_admin
         self.s3_data = s3_data
+        self.s3_endpoint_url = s3_endpoint_url
+        self.__s3_client = None
+        self.__s3_transfer_config = None
+        self.normalized = normalized
+        self.profile_directory = profile_directory
+        self.__profile_stack = list()
+        self.__profile_count = 0
+        self.__profile_lock = threading.Lock()
 
     TOLERANCE = 5
 
+    # bounds of the tweepy collection pipeline: fetchers block once the parse stage is this far behind
+    PAGE_QUEUE_SIZE = 16
+    ROW_QUEUE_SIZE = 16
+    COMMIT_EVERY = 1000
+
+    # a query whose first page predicts more tweets than WINDOW_TWEETS is split into disjoint time windows
+    PROBE_TWEETS = 100
+    WINDOW_TWEETS = 2000
+    MAX_SEARCH_WINDOWS = 16
+    TWINT_WINDOW_WORKERS = 4
+    TWEEPY_FETCHERS_PER_CREDENTIAL = 4
+
+    # standard search and the twint searches only go this far back
+    SEARCH_WINDOW = timedelta(days=7)
+
+    # profiles resolved through users/lookup are reused for this long
+    USER_PROFILE_TTL = timedelta(days=7)
+
+    # uploads above the threshold are sent as parallel multipart transfers of this chunk size
+    S3_MULTIPART_THRESHOLD = 64 * 2**20
+    S3_MULTIPART_CHUNKSIZE = 64 * 2**20
+    S3_MAX_CONCURRENCY = 16
+    S3_MAX_POOL_CONNECTIONS = 32
+
+    # how long the result of each class of control query can be served from the local cache
+    QUERY_CACHE_TTL = {
+        'filter_terms': timedelta(hours=12)
+    }
+
+    @contextmanager
+    def profile_stage(self, stage):
+        if self.profile_directory is None:
+            yield
+            return
+
+        Path(self.profile_directory).mkdir(parents=True, exist_ok=True)
+        if self.__profile_stack:
+            # a nested stage keeps its calls out of the enclosing stage's profile; its wall, cpu and memory
+            # still count towards the enclosing stage
+            parent = self.__profile_stack[-1]
+            parent['profiler'].disable()
+            parent['peak'] = max(parent['peak'], self.__traced_peak(parent))
+        else:
+            tracemalloc.start()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.__profile_count += 1
+        current = {'name': "{:02d}_{}".format(self.__profile_count, stage),
+                   'profiler': cProfile.Profile(),
+                   'thread_profilers': list(),
+                   'snapshot': tracemalloc.take_snapshot(),
+                   'peak': 0,
+                   'traced_at_start': tracemalloc.get_traced_memory(),
+                   'wall': time.time(),
+                   'cpu': time.process_time()}
+        self.__profile_stack.append(current)
+        current['profiler'].enable()
+        try:
+            yield
+        finally:
+            current['profiler'].disable()
+            wall = time.time() - current['wall']
+            cpu = time.process_time() - current['cpu']
+            current['peak'] = max(current['peak'], self.__traced_peak(current))
+            allocations = tracemalloc.take_snapshot().compare_to(current['snapshot'], 'lineno')
+            self.__profile_stack.pop()
+
+            top_functions = io.StringIO()
+            stats = pstats.Stats(current['profiler'], stream=top_functions)
+            with self.__profile_lock:
+                for profiler in current['thread_profilers']:
+                    stats.add(profiler)
+            stats.dump_stats(str(Path(self.profile_directory, current['name'] + '.pstats')))
+            with open(str(Path(self.profile_directory, current['name'] + '_allocations.txt')), 'w') as allocation_writer:
+                for allocation in allocations[:25]:
+                    allocation_writer.write("{}\n".format(allocation))
+            stats.sort_stats('cumulative').print_stats(5)
+            with open(str(Path(self.profile_directory, 'summary.txt')), 'a') as summary_writer:
+                summary_writer.write("{}: wall {:.1f}s, cpu {:.1f}s, peak traced {:.1f} MiB, peak rss {:.1f} MiB\n".format(
+                    current['name'], wall, cpu, current['peak'] / 2**20,
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10))
+                summary_writer.write(top_functions.getvalue())
+
+            if self.__profile_stack:
+                parent = self.__profile_stack[-1]
+                parent['peak'] = max(parent['peak'], current['peak'])
+                parent['profiler'].enable()
+            else:
+                tracemalloc.stop()
+
+    @staticmethod
+    def __traced_peak(stage):
+        size, peak = tracemalloc.get_traced_memory()
+        if not hasattr(tracemalloc, 'reset_peak') and peak <= stage['traced_at_start'][1]:
+            # before Python 3.9 the peak cannot be reset: a stage that sets no new high reports the most it
+            # was seen to hold
+            return max(size, stage['traced_at_start'][0])
+        return peak
+
+    def profiled(self, target):
+        # cProfile only follows the thread that enables it, so work run on other threads gets a profiler of
+        # its own, which is merged into the stage that started it
+        if not self.__profile_stack:
+            return target
+        current = self.__profile_stack[-1]
+
+        def run(*args, **kwargs):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # from Python 3.12 a profiler covers every thread, and the stage's profiler already sees this one
+                return target(*args, **kwargs)
+            try:
+                return target(*args, **kwargs)
+            finally:
+                profiler.disable()
+                with self.__profile_lock:
+                    current['thread_profilers'].append(profiler)
+        return run
+
+    def __connect_database(self):
+        database_file = Path(Path(__file__).parent, 'tmp', 'twitter_search.sqlite')
+        Path(database_file).parent.mkdir(parents=True, exist_ok=True)
+        database = sqlite3.connect(str(database_file))
+        database.row_factory = sqlite3.Row
+        return database
+
+    @staticmethod
+    def __query_cache_key(query, parameters):
+        normalized_query = " ".join(query.split()).rstrip(';').strip()
+        normalized_parameters = json.dumps(parameters, sort_keys=True)
+        return normalized_query, hashlib.sha256("{}\n{}".format(normalized_query,
+                                                                 normalized_parameters).encode()).hexdigest()
+
+    def query_athena_cached(self, athena_db, query_class, query, parameters):
+        normalized_query, cache_key = self.__query_cache_key(query, parameters)
+        oldest_valid = (datetime.utcnow() - self.QUERY_CACHE_TTL[query_class]).strftime('%Y-%m-%d %H:%M:%S')
+        database = self.__connect_database()
+        try:
+            database.execute(CREATE_TABLE_ATHENA_QUERY_CACHE)
+            cached = database.execute("select result from athena_query_cache where cache_key = ? and created_at >= ?",
+                                      (cache_key, oldest_valid)).fetchone()
+            if cached is not None:
+                return json.loads(cached['result'])
+            result = athena_db.query_athena_and_get_result(query_string=query.format(**parameters))
+            database.execute("insert or replace into athena_query_cache (cache_key, query_class, query, result) "
+                             "values (?, ?, ?, ?)",
+                             (cache_key, query_class, normalized_query, json.dumps(result)))
+            database.commit()
+            return result
+        finally:
+            database.close()
+
+    def invalidate_query_cache(self, query_class=None):
+        database = self.__connect_database()
+        try:
+            database.execute(CREATE_TABLE_ATHENA_QUERY_CACHE)
+            if query_class is None:
+                database.execute("delete from athena_query_cache")
+            else:
+                database.execute("delete from athena_query_cache where query_class = ?", (query_class,))
+            database.commit()
+        finally:
+            database.close()
+
+    def s3_client(self):
+        # one client and connection pool is shared by every upload of the run
+        if self.__s3_client is None:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+
+            self.__s3_client = boto3.client('s3',
+                                            endpoint_url=self.s3_endpoint_url,
+                                            config=Config(max_pool_connections=self.S3_MAX_POOL_CONNECTIONS))
+            self.__s3_transfer_config = TransferConfig(multipart_threshold=self.S3_MULTIPART_THRESHOLD,
+                                                       multipart_chunksize=self.S3_MULTIPART_CHUNKSIZE,
+                                                       max_concurrency=self.S3_MAX_CONCURRENCY,
+                                                       use_threads=True)
+        return self.__s3_client
+
+    @staticmethod
+    def file_sha256(filename):
+        digest = hashlib.sha256()
+        with open(str(filename), 'rb') as f_in:
+            for chunk in iter(lambda: f_in.read(2**20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def upload_to_s3(self, filename, s3_filename):
+        from botocore.exceptions import ClientError
+
+        s3 = self.s3_client()
+        content_hash = self.file_sha256(filename)
+        try:
+            # the hash travels with the object, so an unchanged file is not sent again on a rerun
+            uploaded = s3.head_object(Bucket=self.s3_data, Key=s3_filename)
+            if uploaded.get('Metadata', {}).get('sha256') == content_hash:
+                print(str(datetime.utcnow()) + ' unchanged, not uploaded: s3://{}/{}'.format(self.s3_data,
+                                                                                            s3_filename))
+                return False
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+        s3.upload_file(str(filename), self.s3_data, s3_filename,
+                       ExtraArgs={'Metadata': {'sha256': content_hash}},
+                       Config=self.__s3_transfer_config)
+        print(str(datetime.utcnow()) + ' uploaded: s3://{}/{}'.format(self.s3_data, s3_filename))
+        return True
+
+    def update_known_video_index(self, athena_db, database):
+        database.execute(CREATE_TABLE_KNOWN_VIDEO)
+        database.execute(CREATE_INDEX_KNOWN_VIDEO_CREATION_DATE)
+        # the latest partition is fetched again because a rerun on the same day may have added ids to it
+        last_creation_date = database.execute("select max(creation_date) as last from known_video").fetchone()['last']
+        known_videos_filename = Path(Path(__file__).parent, 'tmp', 'known_videos.csv')
+        known_videos = athena_db.query_athena_and_download(
+            query_string=KNOWN_VIDEOS.format(since=last_creation_date or ''),
+            filename=known_videos_filename)
+        with open(str(known_videos), newline='', encoding="utf8") as f_in:
+            reader = csv.DictReader(f_in)
+            database.executemany("insert or ignore into known_video (id, creation_date) values (?, ?)",
+                                 ((video['id'], video['creation_date']) for video in reader))
+        database.commit()
+        return last_creation_date or ''
+
     def update_table_youtube_twitter_addition(self):
+        from internet_scholar import AthenaDatabase
+
         athena_db = AthenaDatabase(database=self.athena_data, s3_output=self.s3_admin)
-        new_videos_filename = Path(Path(__file__).parent, 'tmp', 'new_videos_today.csv')
-        Path(new_videos_filename).parent.mkdir(parents=True, exist_ok=True)
-        new_videos = athena_db.query_athena_and_download(query_string=NEW_VIDEOS_TODAY, filename=new_videos_filename)
+        database = self.__connect_database()
+        try:
+            since = self.update_known_video_index(athena_db=athena_db, database=database)
+            known_video_ids = set(row['id'] for row in database.execute("select id from known_video"))
+
+            new_videos_filename = Path(Path(__file__).parent, 'tmp', 'new_videos_today.csv')
+            new_videos = athena_db.query_athena_and_download(query_string=NEW_VIDEOS_TODAY.format(since=since),
+                                                             filename=new_videos_filename)
 
-        new_videos_compressed = Path(Path(__file__).parent, 'tmp', 'new_videos.csv.gz')
-        with open(str(new_videos), 'rt') as f_in:
-            with gzip.open(str(new_videos_compressed), 'wt') as f_out:
+            today = datetime.utcnow().strftime("%Y-%m-%d")
+            with open(str(new_videos), 'rt') as f_in:
                 reader = csv.DictReader(f_in)
                 for video_id in reader:
-                    f_out.write(video_id['id'] + '\n')
+                    if video_id['id'] and video_id['id'] not in known_video_ids:
+                        known_video_ids.add(video_id['id'])
+                        database.execute("insert into known_video (id, creation_date) values (?, ?)",
+                                         (video_id['id'], today))
+
+            # today's partition is rewritten as a whole, so a rerun keeps the ids added earlier in the day
+            new_videos_compressed = Path(Path(__file__).parent, 'tmp', 'new_videos.csv.gz')
+            # a fixed header timestamp keeps the archive byte-identical while its contents do not change
+            with open(str(new_videos_compressed), 'wb') as f_raw, \
+                    gzip.GzipFile(fileobj=f_raw, mode='wb', mtime=0) as f_out:
+                for video_id in database.execute("select id from known_video where creation_date = ?", (today,)):
+                    f_out.write((video_id['id'] + '\n').encode())
+
+            s3_filename = "youtube_twitter_addition/creation_date={}/video_ids.csv.gz".format(today)
+            self.upload_to_s3(filename=new_videos_compressed, s3_filename=s3_filename)
+            database.commit()
+
+            athena_db.query_athena_and_wait(query_string="MSCK REPAIR TABLE youtube_twitter_addition")
+        finally:
+            database.close()
+
+    def search_cache_since(self, database, method, collection, keys, window_start):
+        # a term covered up to some point since the start of the window only needs the part after it
+        database.execute(CREATE_TABLE_SEARCH_COVERAGE)
+        database.execute(CREATE_TABLE_SEARCH_COVERAGE_TWEET)
+        database.execute(CREATE_TABLE_RUN_STATE)
+        since_by_key = dict()
+        hits = 0
+        for key in keys:
+            coverage = database.execute("select covered_since, covered_until from search_coverage "
+                                        "where method = ? and collection = ? and term = ?",
+                                        (method, collection,
+                                         key.lower() if collection == 'screen_name' else key)).fetchone()
+            if coverage is not None and coverage['covered_since'] <= window_start.strftime('%Y-%m-%d %H:%M:%S'):
+                since_by_key[key] = datetime.strptime(coverage['covered_until'], '%Y-%m-%d %H:%M:%S')
+                hits += 1
+            else:
+                since_by_key[key] = window_start
+        statistics = {'hits': hits, 'misses': len(keys) - hits,
+                      'hours_skipped': round(sum((since - window_start).total_seconds()
+                                                 for since in since_by_key.values()) / 3600, 1)}
+        print("{} search cache {} {}: {} hits, {} misses, {} term-hours not searched again".format(
+            str(datetime.utcnow()), method, collection, statistics['hits'], statistics['misses'],
+            statistics['hours_skipped']))
+        database.execute("insert or replace into run_state (key, value) values (?, ?)",
+                         ('search_cache_{}_{}'.format(method, collection), json_dumps(statistics)))
+        database.commit()
+        return since_by_key
+
+    def batches_by_since(self, keys, since_by_key):
+        # terms that need the same part of the window are searched together
+        keys = sorted(keys, key=lambda key: since_by_key[key])
+        return [(keys[i:i + 5], min(since_by_key[key] for key in keys[i:i + 5])) for i in range(0, len(keys), 5)]
+
+    def record_search_coverage(self, database, method, collection, keys, since_by_key, window_start, searched_at):
+        for key in keys:
+            term = key.lower() if collection == 'screen_name' else key
+            if since_by_key.get(key, window_start) > window_start:
+                # the search continued an existing coverage, which keeps its start
+                database.execute("update search_coverage set covered_until = ? "
+                                 "where method = ? and collection = ? and term = ?",
+                                 (searched_at.strftime('%Y-%m-%d %H:%M:%S'), method, collection, term))
+            else:
+                database.execute("insert or replace into search_coverage "
+                                 "(method, collection, term, covered_since, covered_until) values (?, ?, ?, ?, ?)",
+                                 (method, collection, term, window_start.strftime('%Y-%m-%d %H:%M:%S'),
+                                  searched_at.strftime('%Y-%m-%d %H:%M:%S')))
 
-        s3 = boto3.resource('s3')
-        s3_filename = "youtube_twitter_addition/creation_date={}/video_ids.csv.gz".format(datetime.utcnow().strftime("%Y-%m-%d"))
-        s3.Bucket(self.s3_data).upload_file(str(new_videos_compressed), s3_filename)
+    def coverage_terms(self, method, collection, keys, id_str, screen_name, created_at, json_line):
+        if collection == 'video_id':
+            return [(method, collection, key, id_str, screen_name, created_at) for key in keys if key in json_line]
+        return [(method, collection, key.lower(), id_str, screen_name, created_at)
+                for key in keys if key.lower() == screen_name.lower()]
 
-        athena_db.query_athena_and_wait(query_string="MSCK REPAIR TABLE youtube_twitter_addition")
+    def users_from_covered_tweets(self, database, method):
+        # a video that hit the search cache is only searched for its newest tweets, so the authors of the
+        # covered part come from the tweets recorded when that part was searched
+        database.execute(CREATE_TABLE_SEARCH_COVERAGE_TWEET)
+        return [(row['screen_name'], row['created_at'], None) for row in database.execute(
+            "select search_coverage_tweet.screen_name, max(search_coverage_tweet.created_at) as created_at "
+            "from search_coverage_tweet "
+            "join youtube_video_id on youtube_video_id.id = search_coverage_tweet.term "
+            "where search_coverage_tweet.method = ? and search_coverage_tweet.collection = 'video_id' "
+            "group by search_coverage_tweet.screen_name", (method,)).fetchall()]
+
+    def twint_resilient(self, filename, query, since, until=None, limit=None, num_attempts=0):
+        import twint
 
-    def twint_resilient(self, filename, query, since, num_attempts=0):
         try:
             c = twint.Config()
             c.Search = query
             c.Since = since
+            if until is not None:
+                c.Until = until
+            if limit is not None:
+                c.Limit = limit
             c.Database = str(filename)
             twint.run.Search(c)
             num_attempts = 0
@@ -592,90 +1191,552 @@ class TwitterSearch:
                 self.twint_resilient(filename=filename,
                                      query=query,
                                      since=since,
+                                     until=until,
+                                     limit=limit,
                                      num_attempts=num_attempts+1)
 
-    def collect_user_tweets_tweepy(self, filter_terms, new_videos_yesterday_file, num_attempts=0):
-        database_file = Path(Path(__file__).parent, 'tmp', 'twitter_search.sqlite')
-        Path(database_file).parent.mkdir(parents=True, exist_ok=True)
-        database = sqlite3.connect(str(database_file))
-        database.row_factory = sqlite3.Row
+    def plan_search_windows(self, first_page_times, window_start):
+        # the density of the first page tells how many tweets the rest of the search window holds
+        if len(first_page_times) < self.PROBE_TWEETS:
+            return []
+        oldest = min(first_page_times)
+        span = max((max(first_page_times) - oldest).total_seconds(), 1)
+        remaining = (oldest - window_start).total_seconds()
+        if remaining <= 0:
+            return []
+        estimated_tweets = len(first_page_times) * remaining / span
+        if estimated_tweets <= self.WINDOW_TWEETS:
+            return []
+        num_windows = min(self.MAX_SEARCH_WINDOWS, int(math.ceil(estimated_tweets / self.WINDOW_TWEETS)))
+        step = (oldest - window_start) / num_windows
+        return [(window_start + step * i, window_start + step * (i + 1) if i < num_windows - 1 else oldest)
+                for i in range(num_windows)]
+
+    def __merge_twint_database(self, source, destination):
+        destination_db = sqlite3.connect(str(destination))
         try:
-            auth = tweepy.OAuthHandler(consumer_key=self.credentials['consumer_key'],
-                                       consumer_secret=self.credentials['consumer_secret'])
-            auth.set_access_token(key=self.credentials['access_token'],
-                                  secret=self.credentials['access_token_secret'])
-            api = tweepy.API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+            destination_db.execute("attach database ? as window", (str(source),))
+            if destination_db.execute("select name from main.sqlite_master "
+                                      "where type = 'table' and name = 'tweets'").fetchone() is None:
+                destination_db.execute(destination_db.execute("select sql from window.sqlite_master "
+                                                              "where type = 'table' and name = 'tweets'").fetchone()[0])
+            destination_db.execute("insert into main.tweets select * from window.tweets "
+                                   "where id not in (select id from main.tweets)")
+            destination_db.commit()
+            destination_db.execute("detach database window")
+        finally:
+            destination_db.close()
+
+    def __twint_window(self, window_file, query, since_at, until_at):
+        # twint drives its own asyncio loop, which needs to exist on this thread
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        if window_file.exists():
+            window_file.unlink()
+        self.twint_resilient(filename=window_file, query=query, since=since_at, until=until_at)
+        return window_file
+
+    def search_twint_adaptive(self, database, collection, filename, query, since):
+        database.execute(CREATE_TABLE_SEARCH_WINDOW)
+        if database.execute("select count(*) as total from search_window "
+                            "where method = 'twint' and collection = ? and query = ?",
+                            (collection, query)).fetchone()['total'] == 0:
+            probe_file = Path(Path(__file__).parent, 'tmp', 'twint_probe.sqlite')
+            if probe_file.exists():
+                probe_file.unlink()
+            self.twint_resilient(filename=probe_file, query=query, since=since, limit=self.PROBE_TWEETS)
+            probe_db = sqlite3.connect(str(probe_file))
+            try:
+                first_page_times = [datetime.utcfromtimestamp(row[0]/1000)
+                                    for row in probe_db.execute("select created_at from tweets")]
+            finally:
+                probe_db.close()
+            self.__merge_twint_database(source=probe_file, destination=filename)
+            probe_file.unlink()
+            if len(first_page_times) < self.PROBE_TWEETS:
+                # the probe already holds every tweet of the query
+                database.commit()
+                return
+            since_at = datetime.strptime(since, '%Y-%m-%d %H:%M:%S' if len(since) > 10 else '%Y-%m-%d')
+            windows = self.plan_search_windows(first_page_times, since_at)
+            if not windows:
+                # the rest of the window is small enough for a single search, which ends where the probe ended
+                if min(first_page_times) > since_at:
+                    self.twint_resilient(filename=filename, query=query, since=since,
+                                         until=min(first_page_times).strftime('%Y-%m-%d %H:%M:%S'))
+                database.commit()
+                return
+            database.executemany("insert or ignore into search_window (method, collection, query, since_at, until_at) "
+                                 "values ('twint', ?, ?, ?, ?)",
+                                 ((collection, query, start.strftime('%Y-%m-%d %H:%M:%S'),
+                                   end.strftime('%Y-%m-%d %H:%M:%S')) for start, end in windows))
+            database.commit()
+            print("{} split into {} windows: {}".format(str(datetime.utcnow()), len(windows), query))
+
+        pending = database.execute("select since_at, until_at from search_window "
+                                   "where method = 'twint' and collection = ? and query = ? and processed = 0",
+                                   (collection, query)).fetchall()
+        with ThreadPoolExecutor(max_workers=self.TWINT_WINDOW_WORKERS) as executor:
+            futures = {executor.submit(self.profiled(self.__twint_window),
+                                       window_file=Path(Path(__file__).parent, 'tmp',
+                                                        'twint_window_{}.sqlite'.format(number)),
+                                       query=query,
+                                       since_at=window['since_at'],
+                                       until_at=window['until_at']): window['since_at']
+                       for number, window in enumerate(pending)}
+            # each window is merged and marked as soon as it is done, so a rerun only searches the missing ones
+            for future in as_completed(futures):
+                window_file = future.result()
+                self.__merge_twint_database(source=window_file, destination=filename)
+                window_file.unlink()
+                database.execute("update search_window set processed = 1 "
+                                 "where method = 'twint' and collection = ? and query = ? and since_at = ?",
+                                 (collection, query, futures[future]))
+                database.commit()
+
+    def __twint_batch_file(self, collection):
+        return Path(Path(__file__).parent, 'tmp', 'twint_batch_{}.sqlite'.format(collection))
+
+    def __resume_twint_windows(self, database, collection, filename):
+        database.execute(CREATE_TABLE_SEARCH_WINDOW)
+        # tweets of a batch that stopped halfway are kept; its coverage is not recorded, so it is searched again
+        batch_file = self.__twint_batch_file(collection)
+        if batch_file.exists():
+            self.__merge_twint_database(source=batch_file, destination=filename)
+            batch_file.unlink()
+        for row in database.execute("select distinct query from search_window "
+                                    "where method = 'twint' and collection = ? and processed = 0",
+                                    (collection,)).fetchall():
+            self.search_twint_adaptive(database=database, collection=collection, filename=filename,
+                                       query=row['query'], since=None)
+
+    def credentials_list(self):
+        # the configuration may hold a single set of credentials or a list of them
+        return self.credentials if isinstance(self.credentials, list) else [self.credentials]
+
+    def twitter_api(self, credentials=None):
+        import tweepy
+
+        credentials = credentials or self.credentials_list()[0]
+        auth = tweepy.OAuthHandler(consumer_key=credentials['consumer_key'],
+                                   consumer_secret=credentials['consumer_secret'])
+        auth.set_access_token(key=credentials['access_token'],
+                              secret=credentials['access_token_secret'])
+        return tweepy.API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+
+    def __users_from_tweepy_tweets(self, database, table):
+        for row in database.execute("select tweet from {}".format(table)).fetchall():
+            tweet = json_loads(row['tweet'])
+            yield (tweet['user']['screen_name'],
+                   datetime.strftime(datetime.strptime(tweet['created_at'], '%a %b %d %H:%M:%S +0000 %Y'),
+                                     '%Y-%m-%d %H:%M:%S'),
+                   tweet['user'])
+
+    def __users_from_hybrid_tweets(self, database):
+        for row in database.execute("select tweet from hybrid_tweet where collection = 'video_id'").fetchall():
+            tweet = json_loads(row['tweet'])
+            yield tweet['screen_name'], tweet['created_at'], None
+
+    def __classify_user(self, user, last_tweet_at, oldest_active):
+        if user.get('protected'):
+            return 'protected'
+        if last_tweet_at is None or last_tweet_at < oldest_active:
+            return 'inactive'
+        return 'active'
+
+    def prescreen_users(self, database, api, seen_users):
+        import tweepy
+
+        database.execute(CREATE_TABLE_USER_PROFILE)
+        # twint searches from midnight of the first day of the window, so that is where activity starts to count
+        oldest_active = (datetime.utcnow() - self.SEARCH_WINDOW).strftime('%Y-%m-%d 00:00:00')
+
+        # a collected tweet only proves that its author was active at least until then: it orders the users,
+        # and only users/lookup decides that someone is inactive
+        latest = dict()
+        for screen_name, last_tweet_at, user in seen_users:
+            if screen_name.lower() not in latest or latest[screen_name.lower()][1] < last_tweet_at:
+                latest[screen_name.lower()] = (screen_name, last_tweet_at, user)
+        for screen_name, last_tweet_at, user in latest.values():
+            database.execute("insert or ignore into twitter_user_profile (screen_name, updated_at) values (?, null)",
+                             (screen_name,))
+            database.execute("update twitter_user_profile set status = ?, "
+                             "last_tweet_at = max(coalesce(last_tweet_at, ''), ?), "
+                             "id_str = coalesce(?, id_str), profile = coalesce(?, profile) "
+                             "where screen_name = ?",
+                             ('protected' if user is not None and user.get('protected') else 'active',
+                              last_tweet_at,
+                              user['id_str'] if user is not None else None,
+                              json_dumps(user) if user is not None else None,
+                              screen_name))
+        database.commit()
+
+        if api is not None:
+            oldest_valid = (datetime.utcnow() - self.USER_PROFILE_TTL).strftime('%Y-%m-%d %H:%M:%S')
+            unresolved = [(row['screen_name'], row['last_tweet_at']) for row in database.execute(
+                "select twitter_user.screen_name, twitter_user_profile.last_tweet_at from twitter_user "
+                "left join twitter_user_profile on twitter_user_profile.screen_name = twitter_user.screen_name "
+                "where twitter_user.processed = 0 "
+                "and (twitter_user_profile.updated_at is null or twitter_user_profile.updated_at < ?)",
+                (oldest_valid,)).fetchall()]
+            for i in range(0, len(unresolved), 100):
+                batch = unresolved[i:i + 100]
+                try:
+                    users = {user.screen_name.lower(): user._json
+                             for user in api.lookup_users(screen_names=[screen_name for screen_name, _ in batch])}
+                except tweepy.TweepError as e:
+                    # users/lookup answers 404 when none of the screen names exists anymore
+                    if getattr(e, 'api_code', None) != 17:
+                        raise
+                    users = dict()
+                for screen_name, seen_at in batch:
+                    user = users.get(screen_name.lower())
+                    if user is None:
+                        # suspended, deactivated or renamed
+                        status, last_tweet_at = 'unavailable', seen_at
+                    else:
+                        last_tweet_at = seen_at
+                        if 'status' in user:
+                            last_tweet_at = max(last_tweet_at or '', datetime.strftime(
+                                datetime.strptime(user['status']['created_at'], '%a %b %d %H:%M:%S +0000 %Y'),
+                                '%Y-%m-%d %H:%M:%S'))
+                        status = self.__classify_user(user, last_tweet_at, oldest_active)
+                    database.execute("insert or replace into twitter_user_profile "
+                                     "(screen_name, id_str, status, last_tweet_at, profile) values (?, ?, ?, ?, ?)",
+                                     (screen_name, user['id_str'] if user is not None else None, status,
+                                      last_tweet_at, json_dumps(user) if user is not None else None))
+                database.commit()
+
+        # processed = 2 marks users that are left out of the searches
+        database.execute("update twitter_user set processed = 2 where processed = 0 and exists "
+                         "(select * from twitter_user_profile "
+                         "where twitter_user_profile.screen_name = twitter_user.screen_name "
+                         "and twitter_user_profile.status != 'active')")
+        database.commit()
+        for row in database.execute("select twitter_user_profile.status, count(*) as total from twitter_user "
+                                    "join twitter_user_profile "
+                                    "on twitter_user_profile.screen_name = twitter_user.screen_name "
+                                    "group by twitter_user_profile.status"):
+            print("{} users {}: {}".format(str(datetime.utcnow()), row['status'], row['total']))
+
+    def __tweepy_fetcher(self, api, query_queue, page_queue, metrics, stop):
+        import tweepy
+
+        while True:
+            item = query_queue.get()
+            if item is None:
+                break
+            if stop.is_set():
+                continue
+            collection, query, keys, num_attempts, window, since = item
+            try:
+                print(str(datetime.utcnow()) + ' ' + query)
+                window_ids = dict()
+                if window is not None:
+                    window_ids = {'since_id': window['since_id'], 'max_id': window['max_id']}
+                elif since is not None:
+                    window_ids = {'since_id': snowflake_from_datetime(since)}
+                pages = tweepy.Cursor(api.search, q=query, result_type="recent", count=self.PROBE_TWEETS,
+                                      **window_ids).pages()
+                for page_number, page in enumerate(pages):
+                    if stop.is_set():
+                        # the query is left unfinished: it stays unprocessed for the next attempt
+                        break
+                    if page_queue.full():
+                        metrics['fetcher_blocked'] += 1
+                    page_queue.put(('page', collection, query, keys, page))
+                    if window is None and page_number == 0:
+                        windows = self.plan_search_windows([status.created_at for status in page],
+                                                           since or datetime.utcnow() - self.SEARCH_WINDOW)
+                        if windows:
+                            # the last window ends right before the oldest tweet of the first page
+                            oldest_id = min(status.id for status in page)
+                            page_queue.put(('split', collection, query, keys,
+                                            [{'since_at': start.strftime('%Y-%m-%d %H:%M:%S'),
+                                              'until_at': end.strftime('%Y-%m-%d %H:%M:%S'),
+                                              'since_id': snowflake_from_datetime(start),
+                                              'max_id': snowflake_from_datetime(end) - 1
+                                              if number < len(windows) - 1 else oldest_id - 1}
+                                             for number, (start, end) in enumerate(windows)]))
+                            break
+                else:
+                    page_queue.put(('done', collection, query, keys, window))
+            except Exception as e:
+                print(str(datetime.utcnow()) + ' failed: ' + query + ' (' + repr(e) + ')')
+                if num_attempts >= self.TOLERANCE:
+                    page_queue.put(('error', e))
+                else:
+                    query_queue.put((collection, query, keys, num_attempts + 1, window, since))
+
+    def __tweepy_parser(self, page_queue, row_queue, metrics, stop):
+        while True:
+            message = page_queue.get()
+            if message is None:
+                break
+            if stop.is_set():
+                # keep taking pages so that no fetcher stays blocked, but do not parse them anymore
+                continue
+            if message[0] == 'page':
+                _, collection, query, keys, page = message
+                try:
+                    rows = [(status.id_str, query, status.user.screen_name, json_dumps(status._json))
+                            for status in page]
+                    coverage = [term for status, (id_str, _, screen_name, json_line) in zip(page, rows)
+                                for term in self.coverage_terms('tweepy', collection, keys, id_str, screen_name,
+                                                                status.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+                                                                json_line)]
+                    message = ('rows', collection, rows, coverage)
+                except Exception as e:
+                    message = ('failed', e)
+            if row_queue.full():
+                metrics['parser_blocked'] += 1
+            row_queue.put(message)
+
+    def __run_tweepy_pipeline(self, apis, database, collection, filter_terms):
+        # tweets posted while the phase runs may be missed, so the coverage ends where the phase started
+        phase_start = datetime.utcnow()
+        window_start = phase_start - self.SEARCH_WINDOW
+        if collection == 'video_id':
+            keys = [row['id'] for row in database.execute("select id from youtube_video_id where processed = 0")]
+            table = 'tweet_from_video_id'
+        else:
+            keys = [row['screen_name'] for row in database.execute(PENDING_USERS)]
+            table = 'tweet_from_screen_name'
+        query_queue = queue.Queue()
+        # windows left from an interrupted run are searched again on their own
+        database.execute(CREATE_TABLE_SEARCH_WINDOW)
+        resumed_keys = set()
+        for window in database.execute("select query, keys, since_at, until_at, since_id, max_id from search_window "
+                                       "where method = 'tweepy' and collection = ? and processed = 0",
+                                       (collection,)).fetchall():
+            window_keys = json_loads(window['keys'])
+            resumed_keys.update(window_keys)
+            query_queue.put((collection, window['query'], window_keys, 0,
+                             {'since_at': window['since_at'], 'until_at': window['until_at'],
+                              'since_id': window['since_id'], 'max_id': window['max_id']}, None))
+        keys = [key for key in keys if key not in resumed_keys]
+        since_by_key = self.search_cache_since(database=database, method='tweepy', collection=collection,
+                                               keys=keys, window_start=window_start)
+        for batch, since in self.batches_by_since(keys, since_by_key):
+            query_queue.put((collection, self.build_search_query(collection, batch, filter_terms), batch, 0, None,
+                             since if since > window_start else None))
+        outstanding = query_queue.qsize()
+        total = outstanding
+
+        # fetch (TWEEPY_FETCHERS_PER_CREDENTIAL threads per credential, so the windows of a split query are searched
+        # in parallel) -> parse and serialize -> write (this thread, which owns the database)
+        page_queue = queue.Queue(maxsize=self.PAGE_QUEUE_SIZE)
+        row_queue = queue.Queue(maxsize=self.ROW_QUEUE_SIZE)
+        metrics = {'fetcher_blocked': 0, 'parser_blocked': 0, 'page_queue_peak': 0, 'row_queue_peak': 0}
+        stop = threading.Event()
+        fetchers = [threading.Thread(target=self.profiled(self.__tweepy_fetcher),
+                                     kwargs={'api': api, 'query_queue': query_queue,
+                                             'page_queue': page_queue, 'metrics': metrics, 'stop': stop})
+                    for api in apis for _ in range(self.TWEEPY_FETCHERS_PER_CREDENTIAL)]
+        parser = threading.Thread(target=self.profiled(self.__tweepy_parser),
+                                  kwargs={'page_queue': page_queue, 'row_queue': row_queue, 'metrics': metrics,
+                                          'stop': stop})
+        for thread in fetchers + [parser]:
+            thread.start()
+
+        errors = list()
+        rows_written = 0
+        uncommitted = 0
+        last_report = time.time()
+        try:
+            while outstanding > 0:
+                metrics['page_queue_peak'] = max(metrics['page_queue_peak'], page_queue.qsize())
+                metrics['row_queue_peak'] = max(metrics['row_queue_peak'], row_queue.qsize())
+                try:
+                    message = row_queue.get(timeout=1)
+                except queue.Empty:
+                    # a thread that died outside its own error handling would leave this loop waiting forever
+                    if not parser.is_alive() or not any(fetcher.is_alive() for fetcher in fetchers):
+                        raise RuntimeError("The tweepy pipeline stopped with {} queries outstanding".format(
+                            outstanding))
+                    continue
+                if message[0] == 'rows':
+                    database.executemany("insert or ignore into {} (id_str, query, screen_name, tweet) "
+                                         "values (?, ?, ?, ?)".format(table), message[2])
+                    database.executemany("insert or ignore into search_coverage_tweet "
+                                         "(method, collection, term, id_str, screen_name, created_at) "
+                                         "values (?, ?, ?, ?, ?, ?)", message[3])
+                    rows_written += len(message[2])
+                    uncommitted += len(message[2])
+                elif message[0] == 'split':
+                    _, message_collection, query, message_keys, windows = message
+                    database.executemany("insert or ignore into search_window "
+                                         "(method, collection, query, keys, since_at, until_at, since_id, max_id) "
+                                         "values ('tweepy', ?, ?, ?, ?, ?, ?, ?)",
+                                         ((message_collection, query, json_dumps(message_keys), window['since_at'],
+                                           window['until_at'], window['since_id'], window['max_id'])
+                                          for window in windows))
+                    database.commit()
+                    for window in windows:
+                        query_queue.put((message_collection, query, message_keys, 0, window, None))
+                    print("{} split into {} windows: {}".format(str(datetime.utcnow()), len(windows), query))
+                    outstanding += len(windows) - 1
+                    total += len(windows) - 1
+                elif message[0] == 'done':
+                    _, message_collection, query, message_keys, window = message
+                    # marked in the same transaction as its tweets, so an interrupted query is searched again
+                    if window is not None:
+                        database.execute("update search_window set processed = 1 "
+                                         "where method = 'tweepy' and collection = ? and query = ? and since_at = ?",
+                                         (message_collection, query, window['since_at']))
+                    if window is None or database.execute(
+                            "select count(*) as total from search_window "
+                            "where method = 'tweepy' and collection = ? and query = ? and processed = 0",
+                            (message_collection, query)).fetchone()['total'] == 0:
+                        if message_collection == 'video_id':
+                            database.executemany("update youtube_video_id set processed = 1 where id = ?",
+                                                 ((key,) for key in message_keys))
+                        else:
+                            database.executemany("update twitter_user set processed = 1 where screen_name = ?",
+                                                 ((key,) for key in message_keys))
+                        self.record_search_coverage(database=database, method='tweepy',
+                                                    collection=message_collection, keys=message_keys,
+                                                    since_by_key=since_by_key, window_start=window_start,
+                                                    searched_at=phase_start)
+                    outstanding -= 1
+                elif message[0] == 'error':
+                    errors.append(message[1])
+                    outstanding -= 1
+                else:
+                    raise message[1]
+                if uncommitted >= self.COMMIT_EVERY or outstanding == 0:
+                    database.commit()
+                    uncommitted = 0
+                if time.time() - last_report >= 60 or outstanding == 0:
+                    last_report = time.time()
+                    print("{} {}: {}/{} queries, {} tweets, page queue {} (peak {}, fetchers blocked {}), "
+                          "row queue {} (peak {}, parser blocked {})".format(
+                            str(datetime.utcnow()), collection, total - outstanding, total, rows_written,
+                            page_queue.qsize(), metrics['page_queue_peak'], metrics['fetcher_blocked'],
+                            row_queue.qsize(), metrics['row_queue_peak'], metrics['parser_blocked']))
+        finally:
+            # after a failure the queries left are not fetched: they stay unprocessed for the next attempt
+            stop.set()
+            while not query_queue.empty():
+                query_queue.get_nowait()
+            for _ in fetchers:
+                query_queue.put(None)
+            # drain what is left so that no producer stays blocked on a full queue
+            while any(fetcher.is_alive() for fetcher in fetchers):
+                try:
+                    row_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+                if not parser.is_alive():
+                    # nothing takes the pages of a parser that died
+                    try:
+                        while True:
+                            page_queue.get_nowait()
+                    except queue.Empty:
+                        pass
+            for fetcher in fetchers:
+                fetcher.join()
+            while parser.is_alive():
+                try:
+                    page_queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+                try:
+                    row_queue.get_nowait()
+                except queue.Empty:
+                    pass
+            while parser.is_alive():
+                try:
+                    row_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            parser.join()
+            database.commit()
+        if errors:
+            raise errors[0]
+
+    def collect_user_tweets_tweepy(self, filter_terms, num_attempts=0):
+        database = self.__connect_database()
+        try:
+            apis = [self.twitter_api(credentials) for credentials in self.credentials_list()]
 
             database.execute(CREATE_TABLE_YOUTUBE_VIDEO_ID)
             database.execute(CREATE_TABLE_TWEET_FROM_VIDEO_ID)
             database.execute(CREATE_TABLE_USER)
             database.execute(CREATE_TABLE_TWEET_FROM_SCREEN_NAME)
 
-            cursor_insert = database.cursor()
-            with open(new_videos_yesterday_file, newline='', encoding="utf8") as csv_reader:
-                reader = csv.DictReader(csv_reader)
-                for video_id in reader:
-                    cursor_insert.execute("insert or ignore into youtube_video_id (id) values (?)", (video_id['id'],))
-                database.commit()
-
-            cursor_videos = database.cursor()
-            cursor_videos.execute("select id from youtube_video_id where processed = 0")
-            depleted_iterator = False
-            while not depleted_iterator:
-                top_5 = itertools.islice(cursor_videos, 5)
-                depleted_iterator = True
-                query = ""
-                for new_video in top_5:
-                    depleted_iterator = False
-                    query = "https://www.youtube.com/watch?v={v} OR {query}".format(v=new_video['id'], query=query)
-                    database.execute("update youtube_video_id set processed = 1 where id = ?", (new_video['id'],))
-                if not depleted_iterator:
-                    query = "({query}) {filter}".format(query=query[:-4],
-                                                        filter=" ".join(
-                                                            ['-' + x.strip() for x in filter_terms.split(',')]))
-                    print(str(datetime.utcnow()) + ' ' + query)
-                    for status in tweepy.Cursor(api.search, q=query, result_type="recent").items():
-                        database.execute(
-                            "insert or ignore into tweet_from_video_id (id_str, query, screen_name, tweet) values (?, ?, ?, ?)",
-                            (status.id_str, query, status.user.screen_name, json.dumps(status._json)))
-                    database.commit()
+            self.__run_tweepy_pipeline(apis=apis, database=database, collection='video_id', filter_terms=filter_terms)
 
+            covered_users = self.users_from_covered_tweets(database, 'tweepy')
             database.execute("insert or ignore into twitter_user (screen_name) "
                              "select distinct screen_name from tweet_from_video_id")
+            database.executemany("insert or ignore into twitter_user (screen_name) values (?)",
+                                 ((screen_name,) for screen_name, _, _ in covered_users))
             database.commit()
-            cursor_user = database.cursor()
-            cursor_user.execute("select screen_name from twitter_user where processed = 0")
-            depleted_iterator = False
-            while not depleted_iterator:
-                top_5 = itertools.islice(cursor_user, 5)
-                depleted_iterator = True
-                query = ""
-                for user in top_5:
-                    depleted_iterator = False
-                    query = "from:{user} OR {query}".format(user=user['screen_name'], query=query)
-                    database.execute("update twitter_user set processed = 1 where screen_name = ?", (user['screen_name'],))
-                if not depleted_iterator:
-                    query = "({query}) (youtu.be OR youtube) {filter} filter:links".format(
-                        query=query[:-4],
-                        filter=" ".join(['-' + x.strip() for x in filter_terms.split(',')]))
-                    print(str(datetime.utcnow()) + ' ' + query)
-                    for status in tweepy.Cursor(api.search, q=query, result_type="recent").items():
-                        database.execute(
-                            "insert or ignore into tweet_from_screen_name (id_str, query, screen_name, tweet) values (?, ?, ?, ?)",
-                            (status.id_str, query, status.user.screen_name, json.dumps(status._json)))
-                    database.commit()
-                    num_attempts = 0
+            self.prescreen_users(database=database,
+                                 api=apis[0],
+                                 seen_users=list(self.__users_from_tweepy_tweets(database, 'tweet_from_video_id')) +
+                                 covered_users)
+
+            self.__run_tweepy_pipeline(apis=apis, database=database, collection='screen_name',
+                                       filter_terms=filter_terms)
         except:
             if num_attempts >= self.TOLERANCE:
                 raise
             else:
                 self.collect_user_tweets_tweepy(filter_terms=filter_terms,
-                                                new_videos_yesterday_file=new_videos_yesterday_file,
                                                 num_attempts=num_attempts + 1)
         finally:
             database.close()
 
-    def collect_user_tweets_twint(self, filter_terms, new_videos_yesterday_file, num_attempts=0):
+    def __search_twint_batches(self, database, collection, filename, keys, filter_terms):
+        phase_start = datetime.utcnow()
+        window_start = datetime.strptime(str((phase_start - self.SEARCH_WINDOW).date()), '%Y-%m-%d')
+        since_by_key = self.search_cache_since(database=database, method='twint', collection=collection,
+                                               keys=keys, window_start=window_start)
+        for batch, since in self.batches_by_since(keys, since_by_key):
+            if collection == 'video_id':
+                database.executemany("update youtube_video_id set processed = 1 where id = ?",
+                                     ((key,) for key in batch))
+            else:
+                database.executemany("update twitter_user set processed = 1 where screen_name = ?",
+                                     ((key,) for key in batch))
+            query = self.build_search_query(collection, batch, filter_terms)
+            print(str(datetime.utcnow()) + ' ' + query)
+
+            # each batch is searched into a file of its own, so its tweets are known before they are merged
+            batch_file = self.__twint_batch_file(collection)
+            if batch_file.exists():
+                batch_file.unlink()
+            self.search_twint_adaptive(database=database,
+                                       collection=collection,
+                                       filename=batch_file,
+                                       query=query,
+                                       since=since.strftime('%Y-%m-%d %H:%M:%S') if since > window_start
+                                       else since.strftime('%Y-%m-%d'))
+
+            if batch_file.exists():
+                twint_db = sqlite3.connect(str(batch_file))
+                try:
+                    database.executemany("insert or ignore into search_coverage_tweet "
+                                         "(method, collection, term, id_str, screen_name, created_at) "
+                                         "values (?, ?, ?, ?, ?, ?)",
+                                         [term for id_str, screen_name, created_at, urls in twint_db.execute(
+                                             "select id_str, screen_name, created_at, urls from tweets")
+                                          for term in self.coverage_terms(
+                                              'twint', collection, batch, id_str, screen_name or '',
+                                              datetime.utcfromtimestamp(created_at/1000).strftime('%Y-%m-%d %H:%M:%S'),
+                                              urls or '')])
+                finally:
+                    twint_db.close()
+                self.__merge_twint_database(source=batch_file, destination=filename)
+                batch_file.unlink()
+            self.record_search_coverage(database=database, method='twint', collection=collection,
+                                        keys=batch, since_by_key=since_by_key, window_start=window_start,
+                                        searched_at=phase_start)
+            database.commit()
+
+    def collect_user_tweets_twint(self, filter_terms, num_attempts=0):
         database_file = Path(Path(__file__).parent, 'tmp', 'twitter_search.sqlite')
         Path(database_file).parent.mkdir(parents=True, exist_ok=True)
         database = sqlite3.connect(str(database_file))
@@ -687,102 +1748,439 @@ class TwitterSearch:
             database.execute(CREATE_TABLE_YOUTUBE_VIDEO_ID)
             database.execute(CREATE_TABLE_USER)
 
-            cursor_insert = database.cursor()
-            with open(new_videos_yesterday_file, newline='', encoding="utf8") as csv_reader:
-                reader = csv.DictReader(csv_reader)
-                for video_id in reader:
-                    cursor_insert.execute("insert or ignore into youtube_video_id (id) values (?)", (video_id['id'],))
-                database.commit()
-
-            cursor_videos = database.cursor()
-            cursor_videos.execute("select id from youtube_video_id where processed = 0")
-            depleted_iterator = False
-            while not depleted_iterator:
-                top_5 = itertools.islice(cursor_videos, 5)
-                depleted_iterator = True
-                query = ""
-                for new_video in top_5:
-                    depleted_iterator = False
-                    query = "https://www.youtube.com/watch?v={v} OR {query}".format(v=new_video['id'], query=query)
-                    database.execute("update youtube_video_id set processed = 1 where id = ?", (new_video['id'],))
-                if not depleted_iterator:
-                    query = "({query}) {filter}".format(query=query[:-4],
-                                                        filter=" ".join(
-                                                            ['-' + x.strip() for x in filter_terms.split(',')]))
-                    print(str(datetime.utcnow()) + ' ' + query)
-                    self.twint_resilient(filename=tweet_from_video_id,
-                                         query=query,
-                                         since=str((datetime.utcnow() - timedelta(days=7)).date()))
-                    database.commit()
-                    num_attempts = 0
+            self.__resume_twint_windows(database=database, collection='video_id', filename=tweet_from_video_id)
+            self.__search_twint_batches(database=database,
+                                        collection='video_id',
+                                        filename=tweet_from_video_id,
+                                        keys=[row['id'] for row in database.execute(
+                                            "select id from youtube_video_id where processed = 0").fetchall()],
+                                        filter_terms=filter_terms)
+            num_attempts = 0
 
             tweet_from_video_id_db = sqlite3.connect(str(tweet_from_video_id))
             tweet_from_video_id_db.row_factory = sqlite3.Row
             cursor_new_users = tweet_from_video_id_db.cursor()
-            cursor_new_users.execute("select distinct screen_name from tweets")
+            cursor_new_users.execute("select screen_name, max(created_at) as created_at from tweets group by screen_name")
+            seen_users = list()
             for new_user in cursor_new_users:
                 database.execute("insert or ignore into twitter_user (screen_name) values (?)",
                                  (new_user['screen_name'],))
+                seen_users.append((new_user['screen_name'],
+                                   datetime.utcfromtimestamp(new_user['created_at']/1000).strftime('%Y-%m-%d %H:%M:%S'),
+                                   None))
+            for covered_user in self.users_from_covered_tweets(database, 'twint'):
+                database.execute("insert or ignore into twitter_user (screen_name) values (?)", (covered_user[0],))
+                seen_users.append(covered_user)
             database.commit()
             tweet_from_video_id_db.close()
+            self.prescreen_users(database=database,
+                                 api=self.twitter_api() if self.credentials_list()[0].get('consumer_key') else None,
+                                 seen_users=seen_users)
 
-            cursor_user = database.cursor()
-            cursor_user.execute("select screen_name from twitter_user where processed = 0")
-            depleted_iterator = False
-            while not depleted_iterator:
-                top_5 = itertools.islice(cursor_user, 5)
-                depleted_iterator = True
-                query = ""
-                for user in top_5:
-                    depleted_iterator = False
-                    query = "from:{user} OR {query}".format(user=user['screen_name'], query=query)
-                    database.execute("update twitter_user set processed = 1 where screen_name = ?", (user['screen_name'],))
-                if not depleted_iterator:
-                    query = "({query}) (youtu.be OR youtube) {filter} filter:links".format(
-                        query=query[:-4],
-                        filter=" ".join(['-' + x.strip() for x in filter_terms.split(',')]))
-                    print(str(datetime.utcnow()) + ' ' + query)
-                    self.twint_resilient(filename=tweet_from_screen_name,
-                                         query=query,
-                                         since=str((datetime.utcnow() - timedelta(days=7)).date()))
-                    database.commit()
-                    num_attempts = 0
+            self.__resume_twint_windows(database=database, collection='screen_name', filename=tweet_from_screen_name)
+            self.__search_twint_batches(database=database,
+                                        collection='screen_name',
+                                        filename=tweet_from_screen_name,
+                                        keys=[row['screen_name'] for row in database.execute(PENDING_USERS).fetchall()],
+                                        filter_terms=filter_terms)
+            num_attempts = 0
         except:
             if num_attempts >= self.TOLERANCE:
                 raise
             else:
                 self.collect_user_tweets_twint(filter_terms=filter_terms,
-                                               new_videos_yesterday_file=new_videos_yesterday_file,
                                                num_attempts=num_attempts + 1)
         finally:
             database.close()
 
-    def collect_ancillary_tweets(self, filter_name, method='twint'):
+    def build_search_query(self, collection, keys, filter_terms):
+        exclusions = " ".join(['-' + x.strip() for x in filter_terms.split(',')])
+        if collection == 'video_id':
+            return "({query}) {filter}".format(
+                query=" OR ".join(["https://www.youtube.com/watch?v={v}".format(v=key) for key in keys]),
+                filter=exclusions)
+        else:
+            return "({query}) (youtu.be OR youtube) {filter} filter:links".format(
+                query=" OR ".join(["from:{user}".format(user=key) for key in keys]),
+                filter=exclusions)
+
+    def canonical_tweet_from_tweepy(self, tweet):
+        entities = tweet.get('entities', {})
+        quoted_status_permalink = tweet.get('quoted_status_permalink') or {}
+        return {
+            'created_at': datetime.strftime(datetime.strptime(tweet['created_at'], '%a %b %d %H:%M:%S +0000 %Y'),
+                                            '%Y-%m-%d %H:%M:%S'),
+            'id': tweet['id'],
+            'id_str': tweet['id_str'],
+            'conversation_id': None,
+            'text': tweet.get('full_text', tweet.get('text')),
+            'in_reply_to_status_id_str': tweet.get('in_reply_to_status_id_str'),
+            'user_id': tweet['user']['id'],
+            'user_id_str': tweet['user']['id_str'],
+            'screen_name': tweet['user']['screen_name'],
+            'name': tweet['user']['name'],
+            'replies_count': None,
+            'likes_count': tweet.get('favorite_count'),
+            'retweets_count': tweet.get('retweet_count'),
+            'mentions': [mention['screen_name'] for mention in entities.get('user_mentions', [])],
+            'hashtags': [hashtag['text'] for hashtag in entities.get('hashtags', [])],
+            'urls': [url['expanded_url'] for url in entities.get('urls', [])],
+            'quote_url': quoted_status_permalink.get('expanded'),
+            'link': "https://twitter.com/{}/status/{}".format(tweet['user']['screen_name'], tweet['id_str']),
+            'source': tweet.get('source'),
+            'backend': 'tweepy'
+        }
+
+    def canonical_tweet_from_twint(self, tweet):
+        return {
+            'created_at': datetime.utcfromtimestamp(tweet['created_at']/1000).strftime('%Y-%m-%d %H:%M:%S'),
+            'id': tweet['id'],
+            'id_str': tweet['id_str'],
+            'conversation_id': tweet['conversation_id'],
+            'text': tweet['tweet'],
+            'in_reply_to_status_id_str': None,
+            'user_id': tweet['user_id'],
+            'user_id_str': tweet['user_id_str'],
+            'screen_name': tweet['screen_name'],
+            'name': tweet['name'],
+            'replies_count': tweet['replies_count'],
+            'likes_count': tweet['likes_count'],
+            'retweets_count': tweet['retweets_count'],
+            'mentions': tweet['mentions'].split(',') if tweet['mentions'] != '' else [],
+            'hashtags': tweet['hashtags'].split(',') if tweet['hashtags'] != '' else [],
+            'urls': tweet['urls'].split(',') if tweet['urls'] != '' else [],
+            'quote_url': tweet['quote_url'] or None,
+            'link': tweet['link'],
+            'source': tweet['source'],
+            'backend': 'twint'
+        }
+
+    def __retry_hybrid_item(self, item, work_queue, result_queue, error):
+        collection, query, keys, num_attempts = item
+        print(str(datetime.utcnow()) + ' failed: ' + query + ' (' + repr(error) + ')')
+        if num_attempts >= self.TOLERANCE:
+            result_queue.put(('error', error))
+        else:
+            # whichever backend is free next picks the query up again
+            work_queue.put((collection, query, keys, num_attempts + 1))
+
+    def __wait_for_search_budget(self, api, work_queue, stop):
+        while not stop.is_set() and not work_queue.empty():
+            response = getattr(api, 'last_response', None)
+            if response is None or int(response.headers.get('x-rate-limit-remaining', 1)) > 0:
+                return
+            seconds_to_reset = int(response.headers.get('x-rate-limit-reset', 0)) - time.time()
+            if seconds_to_reset <= 0:
+                return
+            time.sleep(min(seconds_to_reset, 30))
+
+    def __hybrid_tweepy_worker(self, api, work_queue, result_queue, stop):
+        import tweepy
+
+        while True:
+            # leave the queue to twint while the search rate limit is depleted
+            self.__wait_for_search_budget(api=api, work_queue=work_queue, stop=stop)
+            item = work_queue.get()
+            if item is None:
+                break
+            if stop.is_set():
+                continue
+            collection, query, keys, num_attempts = item
+            try:
+                start = time.time()
+                for page in tweepy.Cursor(api.search, q=query, result_type="recent", count=100).pages():
+                    result_queue.put(('tweets', collection, query,
+                                      [self.canonical_tweet_from_tweepy(status._json) for status in page]))
+                result_queue.put(('done', collection, keys, 'tweepy', time.time() - start))
+            except Exception as e:
+                self.__retry_hybrid_item(item=item, work_queue=work_queue, result_queue=result_queue, error=e)
+
+    def __hybrid_twint_worker(self, since, work_queue, result_queue, stop):
+        # twint drives its own asyncio loop, which needs to exist on this thread
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        twint_file = Path(Path(__file__).parent, 'tmp', 'hybrid_twint.sqlite')
+        while True:
+            item = work_queue.get()
+            if item is None:
+                break
+            if stop.is_set():
+                continue
+            collection, query, keys, num_attempts = item
+            try:
+                start = time.time()
+                if twint_file.exists():
+                    twint_file.unlink()
+                self.twint_resilient(filename=twint_file, query=query, since=since)
+                twint_db = sqlite3.connect(str(twint_file))
+                twint_db.row_factory = sqlite3.Row
+                try:
+                    result_queue.put(('tweets', collection, query,
+                                      [self.canonical_tweet_from_twint(tweet)
+                                       for tweet in twint_db.execute("select * from tweets")]))
+                finally:
+                    twint_db.close()
+                result_queue.put(('done', collection, keys, 'twint', time.time() - start))
+            except Exception as e:
+                self.__retry_hybrid_item(item=item, work_queue=work_queue, result_queue=result_queue, error=e)
+
+    def __run_hybrid_phase(self, api, database, collection, filter_terms):
+        if collection == 'video_id':
+            keys = [row['id'] for row in database.execute("select id from youtube_video_id where processed = 0")]
+        else:
+            keys = [row['screen_name']
+                    for row in database.execute(PENDING_USERS)]
+        work_queue = queue.Queue()
+        for i in range(0, len(keys), 5):
+            batch = keys[i:i + 5]
+            work_queue.put((collection, self.build_search_query(collection, batch, filter_terms), batch, 0))
+        outstanding = work_queue.qsize()
+
+        result_queue = queue.Queue()
+        stop = threading.Event()
+        workers = [
+            threading.Thread(target=self.profiled(self.__hybrid_tweepy_worker),
+                             kwargs={'api': api, 'work_queue': work_queue,
+                                     'result_queue': result_queue, 'stop': stop}),
+            threading.Thread(target=self.profiled(self.__hybrid_twint_worker),
+                             kwargs={'since': str((datetime.utcnow() - timedelta(days=7)).date()),
+                                     'work_queue': work_queue, 'result_queue': result_queue, 'stop': stop})
+        ]
+        for worker in workers:
+            worker.start()
+
+        errors = list()
+        statistics = {'tweepy': [0, 0.0], 'twint': [0, 0.0]}
+        try:
+            # this thread is the only one writing to the database
+            while outstanding > 0:
+                message = result_queue.get()
+                if message[0] == 'tweets':
+                    _, message_collection, query, records = message
+                    database.executemany(
+                        "insert or ignore into hybrid_tweet (id_str, collection, query, screen_name, backend, tweet) "
+                        "values (?, ?, ?, ?, ?, ?)",
+                        ((record['id_str'], message_collection, query, record['screen_name'], record['backend'],
+                          json_dumps(record)) for record in records))
+                elif message[0] == 'done':
+                    _, message_collection, message_keys, backend, elapsed = message
+                    if message_collection == 'video_id':
+                        database.executemany("update youtube_video_id set processed = 1 where id = ?",
+                                             ((key,) for key in message_keys))
+                    else:
+                        database.executemany("update twitter_user set processed = 1 where screen_name = ?",
+                                             ((key,) for key in message_keys))
+                    database.commit()
+                    statistics[backend][0] += 1
+                    statistics[backend][1] += elapsed
+                    outstanding -= 1
+                else:
+                    errors.append(message[1])
+                    outstanding -= 1
+        finally:
+            # after a failure the queries left are not searched: they stay unprocessed for the next attempt
+            stop.set()
+            while not work_queue.empty():
+                work_queue.get_nowait()
+            for _ in workers:
+                work_queue.put(None)
+            for worker in workers:
+                worker.join()
+            database.commit()
+        for backend, (num_queries, elapsed) in statistics.items():
+            print("{} {}: {} {} queries in {:.1f}s".format(str(datetime.utcnow()), collection, backend,
+                                                           num_queries, elapsed))
+        if errors:
+            raise errors[0]
+
+    def collect_user_tweets_hybrid(self, filter_terms, num_attempts=0):
+        database = self.__connect_database()
+        try:
+            api = self.twitter_api()
+
+            database.execute(CREATE_TABLE_YOUTUBE_VIDEO_ID)
+            database.execute(CREATE_TABLE_USER)
+            database.execute(CREATE_TABLE_HYBRID_TWEET)
+
+            self.__run_hybrid_phase(api=api, database=database, collection='video_id', filter_terms=filter_terms)
+
+            database.execute("insert or ignore into twitter_user (screen_name) "
+                             "select distinct screen_name from hybrid_tweet where collection = 'video_id'")
+            database.commit()
+            self.prescreen_users(database=database,
+                                 api=api,
+                                 seen_users=self.__users_from_hybrid_tweets(database))
+
+            self.__run_hybrid_phase(api=api, database=database, collection='screen_name', filter_terms=filter_terms)
+        except:
+            if num_attempts >= self.TOLERANCE:
+                raise
+            else:
+                self.collect_user_tweets_hybrid(filter_terms=filter_terms,
+                                                num_attempts=num_attempts + 1)
+        finally:
+            database.close()
+
+    def get_run_state(self, key):
+        database = self.__connect_database()
+        try:
+            database.execute(CREATE_TABLE_RUN_STATE)
+            row = database.execute("select value from run_state where key = ?", (key,)).fetchone()
+            if row is None:
+                raise RuntimeError("No {} in the local state: run the seed stage first".format(key))
+            return row['value']
+        finally:
+            database.close()
+
+    def seed(self, filter_name):
+        from internet_scholar import AthenaDatabase
+
         athena_db = AthenaDatabase(database=self.athena_data, s3_output=self.s3_admin)
 
-        filter_terms = athena_db.query_athena_and_get_result(query_string=FILTER_TERMS.format(name=filter_name))['track']
+        filter_terms = self.query_athena_cached(athena_db=athena_db,
+                                                query_class='filter_terms',
+                                                query=FILTER_TERMS,
+                                                parameters={'name': filter_name})['track']
 
         new_videos_yesterday = Path(Path(__file__).parent, 'tmp', 'new_videos_yesterday.csv')
         Path(new_videos_yesterday).parent.mkdir(parents=True, exist_ok=True)
         new_videos_yesterday_file = athena_db.query_athena_and_download(query_string=NEW_VIDEOS_YESTERDAY,
                                                                         filename=new_videos_yesterday)
-        yesterday = athena_db.query_athena_and_get_result(query_string=YESTERDAY)['yesterday']
+        yesterday = str((datetime.utcnow() - timedelta(days=1)).date())
+
+        database = self.__connect_database()
+        try:
+            database.execute(CREATE_TABLE_RUN_STATE)
+            database.execute(CREATE_TABLE_YOUTUBE_VIDEO_ID)
+            database.execute(CREATE_TABLE_TWEET_FROM_VIDEO_ID)
+            database.execute(CREATE_TABLE_USER)
+            database.execute(CREATE_TABLE_TWEET_FROM_SCREEN_NAME)
+            database.execute(CREATE_TABLE_HYBRID_TWEET)
+            database.execute(CREATE_TABLE_SEARCH_WINDOW)
+            database.execute(CREATE_TABLE_SEARCH_COVERAGE)
+            database.execute(CREATE_TABLE_SEARCH_COVERAGE_TWEET)
+
+            # coverage that no longer reaches into the search window is of no use
+            window_start = datetime.utcnow() - self.SEARCH_WINDOW
+            database.execute("delete from search_coverage where covered_until < ?",
+                             (window_start.strftime('%Y-%m-%d %H:%M:%S'),))
+            database.execute("delete from search_coverage_tweet where cast(id_str as integer) < ?",
+                             (snowflake_from_datetime(window_start),))
+
+            # the work tables hold a single reference date: a rerun on the same day resumes where it stopped
+            previous = database.execute("select value from run_state where key = 'reference_date'").fetchone()
+            if previous is None or previous['value'] != yesterday:
+                for table in ['youtube_video_id', 'twitter_user', 'tweet_from_video_id', 'tweet_from_screen_name',
+                              'hybrid_tweet', 'search_window']:
+                    database.execute("delete from {}".format(table))
+                for twint_file in ['tweet_from_video_id.sqlite', 'tweet_from_screen_name.sqlite']:
+                    if Path(Path(__file__).parent, 'tmp', twint_file).exists():
+                        Path(Path(__file__).parent, 'tmp', twint_file).unlink()
+
+            cursor_insert = database.cursor()
+            with open(new_videos_yesterday_file, newline='', encoding="utf8") as csv_reader:
+                reader = csv.DictReader(csv_reader)
+                for video_id in reader:
+                    cursor_insert.execute("insert or ignore into youtube_video_id (id) values (?)", (video_id['id'],))
+
+            database.execute("insert or replace into run_state (key, value) values ('reference_date', ?)",
+                             (yesterday,))
+            database.execute("insert or replace into run_state (key, value) values ('filter_terms', ?)",
+                             (filter_terms,))
+            database.commit()
+        finally:
+            database.close()
+
+    def collect(self, method='twint'):
+        filter_terms = self.get_run_state('filter_terms')
+        with self.profile_stage('collect_user_tweets_' + method):
+            if method == 'twint':
+                self.collect_user_tweets_twint(filter_terms=filter_terms)
+            elif method == 'hybrid':
+                self.collect_user_tweets_hybrid(filter_terms=filter_terms)
+            else:
+                self.collect_user_tweets_tweepy(filter_terms=filter_terms)
+
+    def export(self, method='twint'):
+        yesterday = self.get_run_state('reference_date')
+        with self.profile_stage('export_' + method):
+            if method == 'twint':
+                self.export_twint(yesterday=yesterday)
+            elif method == 'hybrid':
+                self.export_hybrid(yesterday=yesterday)
+            elif self.normalized:
+                self.export_tweepy_normalized(yesterday=yesterday)
+            else:
+                self.export_tweepy(yesterday=yesterday)
+
+    def register_partitions(self, method='twint'):
+        from internet_scholar import AthenaDatabase
 
         if method == 'twint':
-            self.collect_user_tweets_twint(filter_terms=filter_terms,
-                                          new_videos_yesterday_file=new_videos_yesterday_file)
-            self.export_twint(yesterday=yesterday)
+            tables = [('twint_video_id', ATHENA_CREATE_TWINT_VIDEO_ID, STRUCTURE_TWINT_ATHENA),
+                      ('twint_screen_name', ATHENA_CREATE_TWINT_SCREEN_NAME, STRUCTURE_TWINT_ATHENA)]
+        elif method == 'hybrid':
+            tables = [('hybrid_video_id', ATHENA_CREATE_HYBRID_VIDEO_ID, STRUCTURE_HYBRID_ATHENA),
+                      ('hybrid_screen_name', ATHENA_CREATE_HYBRID_SCREEN_NAME, STRUCTURE_HYBRID_ATHENA)]
+        elif self.normalized:
+            tables = [(table, ATHENA_CREATE_TWEEPY_NORMALIZED.replace('{table}', table), structure)
+                      for table, structure in normalized_tweepy_structures().items()]
         else:
-            self.collect_user_tweets_tweepy(filter_terms=filter_terms,
-                                           new_videos_yesterday_file=new_videos_yesterday_file)
-            self.export_tweepy(yesterday=yesterday)
+            tables = [('tweepy_video_id', ATHENA_CREATE_TWEEPY_VIDEO_ID, STRUCTURE_TWEEPY_ATHENA),
+                      ('tweepy_screen_name', ATHENA_CREATE_TWEEPY_SCREEN_NAME, STRUCTURE_TWEEPY_ATHENA)]
+
+        with self.profile_stage('register_partitions_' + method):
+            athena_db = AthenaDatabase(database=self.athena_data, s3_output=self.s3_admin)
+            for table, create_table, structure in tables:
+                athena_db.query_athena_and_wait(query_string="DROP TABLE {}".format(table))
+                athena_db.query_athena_and_wait(query_string=create_table.format(structure=structure,
+                                                                                 s3_bucket=self.s3_data))
+                athena_db.query_athena_and_wait(query_string="MSCK REPAIR TABLE {}".format(table))
+
+    def benchmark_json(self, limit=10000):
+        database = self.__connect_database()
+        try:
+            tweets = list()
+            for table in ['tweet_from_video_id', 'tweet_from_screen_name', 'hybrid_tweet']:
+                if database.execute("select name from sqlite_master where type = 'table' and name = ?",
+                                    (table,)).fetchone() is not None:
+                    tweets.extend(row['tweet']
+                                  for row in database.execute("select tweet from {} limit ?".format(table), (limit,)))
+        finally:
+            database.close()
+        if not tweets:
+            print("No collected tweets to benchmark: run the collect stage first")
+            return
+
+        expected = [json.loads(tweet) for tweet in tweets]
+        expected_lines = [json_dumps(tweet, backend='json') for tweet in expected]
+        for backend in JSON_BACKENDS:
+            start = time.perf_counter()
+            parsed = [json_loads(tweet, backend=backend) for tweet in tweets]
+            loads_time = time.perf_counter() - start
+            start = time.perf_counter()
+            json_lines = [json_dumps(tweet, backend=backend) for tweet in parsed]
+            dumps_time = time.perf_counter() - start
+            compatible = all(json.loads(json_line) == tweet for json_line, tweet in zip(json_lines, expected))
+            # byte-for-byte differences, such as the formatting of floats, do not change the parsed values
+            identical = sum(json_line == expected_line for json_line, expected_line in zip(json_lines, expected_lines))
+            print("{}: loads {:.1f} us/tweet, dumps {:.1f} us/tweet, {} bytes, compatible: {}, "
+                  "identical to json: {}/{} lines".format(
+                      backend, loads_time / len(tweets) * 1e6, dumps_time / len(tweets) * 1e6,
+                      sum(len(json_line.encode('utf-8')) for json_line in json_lines), compatible,
+                      identical, len(json_lines)))
+
+    def collect_ancillary_tweets(self, filter_name, method='twint'):
+        self.seed(filter_name=filter_name)
+        self.collect(method=method)
+        self.export(method=method)
+        self.register_partitions(method=method)
 
     def create_json_twint_file(self, source, destination):
         source_db = sqlite3.connect(str(source))
         source_db.row_factory = sqlite3.Row
         cursor = source_db.cursor()
         cursor.execute("select * from tweets order by id_str;")
-        with open(destination, 'w') as json_writer:
+        with open(destination, 'w', encoding="utf8") as json_writer:
             for tweet in cursor:
                 new_record = dict()
                 new_record['id'] = tweet['id']
@@ -813,37 +2211,29 @@ class TwitterSearch:
                 new_record['near'] = tweet['near']
                 new_record['source'] = tweet['source']
                 new_record['time_update'] = datetime.utcfromtimestamp(tweet['time_update']/1000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                json_line = json.dumps(new_record)
+                json_line = json_dumps(new_record)
                 json_writer.write("{}\n".format(json_line))
         source_db.close()
 
     def export_twint(self, yesterday):
+        from internet_scholar import compress
+
         tweet_from_video_id = Path(Path(__file__).parent, 'tmp', 'tweet_from_video_id.sqlite')
         json_video_id_file = Path(Path(__file__).parent, 'tmp', 'twint_from_video_id.json')
-        self.create_json_twint_file(source=tweet_from_video_id, destination=json_video_id_file)
+        with self.profile_stage('create_json_twint_file_video_id'):
+            self.create_json_twint_file(source=tweet_from_video_id, destination=json_video_id_file)
         json_video_id_file_compressed = compress(json_video_id_file)
         tweet_from_screen_name = Path(Path(__file__).parent, 'tmp', 'tweet_from_screen_name.sqlite')
         json_screen_name_file = Path(Path(__file__).parent, 'tmp', 'twint_from_screen_name.json')
-        self.create_json_twint_file(source=tweet_from_screen_name, destination=json_screen_name_file)
+        with self.profile_stage('create_json_twint_file_screen_name'):
+            self.create_json_twint_file(source=tweet_from_screen_name, destination=json_screen_name_file)
         json_screen_name_file_compressed = compress(json_screen_name_file)
 
-        s3 = boto3.resource('s3')
         s3_filename = "twint_video_id/reference_date={}/twint_from_video_id.json.bz2".format(yesterday)
-        s3.Bucket(self.s3_data).upload_file(str(json_video_id_file_compressed), s3_filename)
+        self.upload_to_s3(filename=json_video_id_file_compressed, s3_filename=s3_filename)
 
         s3_filename = "twint_screen_name/reference_date={}/twint_from_screen_name.json.bz2".format(yesterday)
-        s3.Bucket(self.s3_data).upload_file(str(json_screen_name_file_compressed), s3_filename)
-
-        athena_db = AthenaDatabase(database=self.athena_data, s3_output=self.s3_admin)
-        athena_db.query_athena_and_wait(query_string="DROP TABLE twint_video_id")
-        athena_db.query_athena_and_wait(query_string=ATHENA_CREATE_TWINT_VIDEO_ID.format(structure=STRUCTURE_TWINT_ATHENA,
-                                                                                         s3_bucket=self.s3_data))
-        athena_db.query_athena_and_wait(query_string="MSCK REPAIR TABLE twint_video_id")
-
-        athena_db.query_athena_and_wait(query_string="DROP TABLE twint_screen_name")
-        athena_db.query_athena_and_wait(query_string=ATHENA_CREATE_TWINT_SCREEN_NAME.format(structure=STRUCTURE_TWINT_ATHENA,
-                                                                                            s3_bucket=self.s3_data))
-        athena_db.query_athena_and_wait(query_string="MSCK REPAIR TABLE twint_screen_name")
+        self.upload_to_s3(filename=json_screen_name_file_compressed, s3_filename=s3_filename)
 
     def __gen_dict_extract(self, key, var):
         if hasattr(var, 'items'):
@@ -865,10 +2255,10 @@ class TwitterSearch:
         cursor = source_db.cursor()
         cursor.execute("select tweet from {} order by id_str;".format(source))
 
-        with open(destination, 'w') as json_writer:
+        with open(destination, 'w', encoding="utf8") as json_writer:
             for tweet in cursor:
                 json_line = tweet['tweet']
-                tweet_json = json.loads(json_line)
+                tweet_json = json_loads(json_line)
                 for created_at in self.__gen_dict_extract('created_at', tweet_json):
                     json_line = json_line.replace(created_at,
                                                   datetime.strftime(datetime.strptime(created_at,
@@ -880,37 +2270,139 @@ class TwitterSearch:
         source_db.close()
 
     def export_tweepy(self, yesterday):
+        from internet_scholar import compress
+
         json_file = Path(Path(__file__).parent, 'tmp', 'tweepy_video_id.json')
-        self.create_json_tweepy_file(source="tweet_from_video_id", destination=json_file)
+        with self.profile_stage('create_json_tweepy_file_video_id'):
+            self.create_json_tweepy_file(source="tweet_from_video_id", destination=json_file)
         json_video_id_file_compressed = compress(json_file)
         json_file = Path(Path(__file__).parent, 'tmp', 'tweepy_user_screen.json')
-        self.create_json_tweepy_file(source="tweet_from_screen_name", destination=json_file)
+        with self.profile_stage('create_json_tweepy_file_screen_name'):
+            self.create_json_tweepy_file(source="tweet_from_screen_name", destination=json_file)
         json_screen_name_file_compressed = compress(json_file)
 
-        s3 = boto3.resource('s3')
         s3_filename = "tweepy_video_id/reference_date={}/tweepy_from_video_id.json.bz2".format(yesterday)
-        s3.Bucket(self.s3_data).upload_file(str(json_video_id_file_compressed), s3_filename)
+        self.upload_to_s3(filename=json_video_id_file_compressed, s3_filename=s3_filename)
 
         s3_filename = "tweepy_screen_name/reference_date={}/tweepy_from_screen_name.json.bz2".format(yesterday)
-        s3.Bucket(self.s3_data).upload_file(str(json_screen_name_file_compressed), s3_filename)
+        self.upload_to_s3(filename=json_screen_name_file_compressed, s3_filename=s3_filename)
 
-        athena_db = AthenaDatabase(database=self.athena_data, s3_output=self.s3_admin)
-        athena_db.query_athena_and_wait(query_string="DROP TABLE tweepy_video_id")
-        athena_db.query_athena_and_wait(query_string=ATHENA_CREATE_TWEEPY_VIDEO_ID.format(structure=STRUCTURE_TWEEPY_ATHENA,
-                                                                                          s3_bucket=self.s3_data))
-        athena_db.query_athena_and_wait(query_string="MSCK REPAIR TABLE tweepy_video_id")
+    def __convert_created_at(self, var):
+        if hasattr(var, 'items'):
+            for k, v in var.items():
+                if k == 'created_at' and isinstance(v, str):
+                    var[k] = datetime.strftime(datetime.strptime(v, '%a %b %d %H:%M:%S +0000 %Y'),
+                                               '%Y-%m-%d %H:%M:%S')
+                elif isinstance(v, dict):
+                    self.__convert_created_at(v)
+                elif isinstance(v, list):
+                    for d in v:
+                        self.__convert_created_at(d)
+
+    def __normalize_status(self, status, users, embedded_statuses):
+        # the user keeps the snapshot attached to the most recent status that mentions it
+        user = status.pop('user')
+        if user['id_str'] not in users or users[user['id_str']][0] < status['created_at']:
+            users[user['id_str']] = (status['created_at'], user)
+        status['user_id_str'] = user['id_str']
+        for key in ['quoted_status', 'retweeted_status']:
+            embedded_status = status.pop(key, None)
+            if embedded_status is not None:
+                status[key + '_id_str'] = embedded_status['id_str']
+                embedded_statuses[embedded_status['id_str']] = self.__normalize_status(embedded_status, users,
+                                                                                       embedded_statuses)
+        return status
+
+    def create_json_tweepy_normalized_files(self, tweet_destination, user_destination, embedded_status_destination):
+        source_db = self.__connect_database()
+        users = dict()
+        embedded_statuses = dict()
+        with open(tweet_destination, 'w', encoding="utf8") as json_writer:
+            for collection, source in [('video_id', 'tweet_from_video_id'), ('screen_name', 'tweet_from_screen_name')]:
+                cursor = source_db.cursor()
+                cursor.execute("select tweet from {} order by id_str;".format(source))
+                for tweet in cursor:
+                    tweet_json = json_loads(tweet['tweet'])
+                    self.__convert_created_at(tweet_json)
+                    tweet_json = self.__normalize_status(tweet_json, users, embedded_statuses)
+                    tweet_json['collection'] = collection
+                    json_writer.write("{}\n".format(json_dumps(tweet_json)))
+        source_db.close()
 
-        athena_db.query_athena_and_wait(query_string="DROP TABLE tweepy_screen_name")
-        athena_db.query_athena_and_wait(query_string=ATHENA_CREATE_TWEEPY_SCREEN_NAME.format(structure=STRUCTURE_TWEEPY_ATHENA,
-                                                                                             s3_bucket=self.s3_data))
-        athena_db.query_athena_and_wait(query_string="MSCK REPAIR TABLE tweepy_screen_name")
+        with open(user_destination, 'w', encoding="utf8") as json_writer:
+            for id_str in sorted(users):
+                json_writer.write("{}\n".format(json_dumps(users[id_str][1])))
+        with open(embedded_status_destination, 'w', encoding="utf8") as json_writer:
+            for id_str in sorted(embedded_statuses):
+                json_writer.write("{}\n".format(json_dumps(embedded_statuses[id_str])))
+
+    def export_tweepy_normalized(self, yesterday):
+        from internet_scholar import compress
+
+        files = {table: Path(Path(__file__).parent, 'tmp', table + '.json')
+                 for table in ['tweepy_tweet', 'tweepy_user', 'tweepy_embedded_status']}
+        with self.profile_stage('create_json_tweepy_normalized_files'):
+            self.create_json_tweepy_normalized_files(tweet_destination=files['tweepy_tweet'],
+                                                     user_destination=files['tweepy_user'],
+                                                     embedded_status_destination=files['tweepy_embedded_status'])
+
+        for table, json_file in files.items():
+            json_file_compressed = compress(json_file)
+            s3_filename = "{table}/reference_date={yesterday}/{table}.json.bz2".format(table=table, yesterday=yesterday)
+            self.upload_to_s3(filename=json_file_compressed, s3_filename=s3_filename)
+
+    def create_json_hybrid_file(self, collection, destination):
+        source_db = self.__connect_database()
+        cursor = source_db.cursor()
+        cursor.execute("select tweet from hybrid_tweet where collection = ? order by id_str;", (collection,))
+        with open(destination, 'w', encoding="utf8") as json_writer:
+            for tweet in cursor:
+                json_writer.write("{}\n".format(tweet['tweet']))
+        source_db.close()
+
+    def export_hybrid(self, yesterday):
+        from internet_scholar import compress
+
+        json_file = Path(Path(__file__).parent, 'tmp', 'hybrid_video_id.json')
+        with self.profile_stage('create_json_hybrid_file_video_id'):
+            self.create_json_hybrid_file(collection="video_id", destination=json_file)
+        json_video_id_file_compressed = compress(json_file)
+        json_file = Path(Path(__file__).parent, 'tmp', 'hybrid_screen_name.json')
+        with self.profile_stage('create_json_hybrid_file_screen_name'):
+            self.create_json_hybrid_file(collection="screen_name", destination=json_file)
+        json_screen_name_file_compressed = compress(json_file)
+
+        s3_filename = "hybrid_video_id/reference_date={}/hybrid_from_video_id.json.bz2".format(yesterday)
+        self.upload_to_s3(filename=json_video_id_file_compressed, s3_filename=s3_filename)
+
+        s3_filename = "hybrid_screen_name/reference_date={}/hybrid_from_screen_name.json.bz2".format(yesterday)
+        self.upload_to_s3(filename=json_screen_name_file_compressed, s3_filename=s3_filename)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='S3 Bucket with configuration', required=True)
-    parser.add_argument('-m', '--method', help='twint or tweepy?', required=True)
+    parser.add_argument('-m', '--method', help='twint, tweepy or hybrid? (not used by seed and benchmark-json)')
+    parser.add_argument('--invalidate-cache', help='Discard cached results of Athena control queries',
+                        action='store_true')
+    parser.add_argument('--profile', help='Write CPU and memory profiles of each stage to tmp/profile',
+                        action='store_true')
+    parser.add_argument('--normalized', help='tweepy only: export tweets, users and embedded statuses '
+                                             'to separate tables instead of nested copies',
+                        action='store_true')
+    parser.add_argument('--s3-endpoint-url', help='Upload to this S3-compatible endpoint instead of AWS '
+                                                  '(e.g. a local stand-in for testing)')
+    stages = parser.add_subparsers(dest='stage', help='Run a single stage (default: all of them)')
+    stages.add_parser('seed', help='Load filter terms and the videos to search into the local state')
+    stages.add_parser('collect', help='Search tweets for the seeded videos and their users')
+    stages.add_parser('export', help='Upload the collected tweets to S3')
+    stages.add_parser('register-partitions', help='Recreate the Athena tables over the exported tweets')
+    stages.add_parser('benchmark-json', help='Compare the available JSON backends on the collected tweets')
     args = parser.parse_args()
+    if args.method is None and args.stage not in ('seed', 'benchmark-json'):
+        parser.error("the following arguments are required: -m/--method")
+
+    from internet_scholar import AthenaLogger, read_dict_from_s3_url
 
     config = read_dict_from_s3_url(url=args.config)
     logger = AthenaLogger(app_name="twitter-search",
@@ -920,8 +2412,26 @@ def main():
         twitter_search = TwitterSearch(credentials=config['twitter'],
                                        athena_data=config['aws']['athena-data'],
                                        s3_admin=config['aws']['s3-admin'],
-                                       s3_data=config['aws']['s3-data'])
-        twitter_search.collect_ancillary_tweets(filter_name=config['parameter']['filter'], method=args.method)
+                                       s3_data=config['aws']['s3-data'],
+                                       profile_directory=Path(Path(__file__).parent, 'tmp', 'profile',
+                                                              datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+                                       if args.profile else None,
+                                       normalized=args.normalized,
+                                       s3_endpoint_url=args.s3_endpoint_url)
+        if args.invalidate_cache:
+            twitter_search.invalidate_query_cache()
+        if args.stage == 'seed':
+            twitter_search.seed(filter_name=config['parameter']['filter'])
+        elif args.stage == 'collect':
+            twitter_search.collect(method=args.method)
+        elif args.stage == 'export':
+            twitter_search.export(method=args.method)
+        elif args.stage == 'register-partitions':
+            twitter_search.register_partitions(method=args.method)
+        elif args.stage == 'benchmark-json':
+            twitter_search.benchmark_json()
+        else:
+            twitter_search.collect_ancillary_tweets(filter_name=config['parameter']['filter'], method=args.method)
         #twitter_search.update_table_youtube_twitter_addition()
     finally:
         logger.save_to_s3()
@@ -929,4 +2439,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()